@@ -1,16 +1,83 @@
 import os
-from flask import Flask, render_template, request, jsonify, make_response
+from flask import Flask, render_template, request, Response, stream_with_context
 import google.generativeai as genai
-import json
-from concurrent.futures import ThreadPoolExecutor
-import concurrent.futures
+import orjson
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
 from urllib.parse import quote
-from xhtml2pdf import pisa
+from jinja2 import FileSystemBytecodeCache
 from io import BytesIO
 import re
+import string
+import heapq
+import hashlib
+import uuid
+import threading
+import tempfile
+import stat
+import diskcache
+import base64
+import asyncio
+import aiohttp
+try:
+    from weasyprint import HTML
+except (ImportError, OSError):
+    # WeasyPrint needs the native Pango libraries, which serverless runtimes such as
+    # Vercel's don't ship; render PDFs with the pure-Python xhtml2pdf there instead
+    HTML = None
+    from xhtml2pdf import pisa
 
 app = Flask(__name__)
-executor = ThreadPoolExecutor(max_workers=10)
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
+# Compiled templates persist on disk so new worker processes skip parsing them.
+# Jinja runs whatever bytecode it loads, so by default let it pick its own
+# per-user 0700 directory, which it refuses to use if someone else owns it
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR")
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+else:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+# Parsed once at startup instead of being looked up on every download
+PDF_TEMPLATE = app.jinja_env.get_template('pdf_template.html')
+# Slow Gemini calls run here; threads are only started when there is work for them
+gemini_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("GEMINI_WORKERS", 32)), thread_name_prefix='gemini')
+
+def private_cache_dir(name):
+    """Per-user 0700 directory under the temp dir, refusing one another user controls."""
+    path = os.path.join(tempfile.gettempdir(), f"{name}-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    path_stat = os.lstat(path)
+    if (not stat.S_ISDIR(path_stat.st_mode) or path_stat.st_uid != os.getuid()
+            or stat.S_IMODE(path_stat.st_mode) & 0o077):
+        raise RuntimeError(f"Refusing to use cache directory {path}: not a private directory owned by this user")
+    return path
+
+# Finished stories and word definitions, on disk so every worker process shares them.
+# diskcache unpickles what it reads, so the default directory must be private to us
+CACHE_DIR = os.environ.get("CACHE_DIR") or private_cache_dir("story-cache")
+STORY_CACHE_TTL = 3600
+DEFINITION_CACHE_TTL = 7 * 86400
+JOB_TTL = 600
+# Background jobs need a process that outlives the response and a cache every
+# instance can read; serverless deployments such as Vercel have neither. Job state
+# lives in the diskcache at CACHE_DIR, so with several instances a /status poll can
+# land on one that never saw the job. They are therefore off unless CACHE_DIR is set
+# explicitly (to storage every instance shares); set BACKGROUND_JOBS=1 to opt in on a single host
+BACKGROUND_JOBS = os.environ.get(
+    "BACKGROUND_JOBS", "1" if os.environ.get("CACHE_DIR") and not os.environ.get("VERCEL") else "0"
+) == "1"
+cache = diskcache.Cache(CACHE_DIR)
+
+# Limits for prefetching story images before PDF rendering
+IMAGE_FETCH_TIMEOUT = 20
+# How long a download waits on the fetch loop before rendering without images
+IMAGE_PREFETCH_DEADLINE = IMAGE_FETCH_TIMEOUT + 5
+IMAGE_FETCH_CONNECTIONS = 64
+# Pollinations rate-limits bursts, so cap concurrent requests to any one host
+IMAGE_FETCH_CONNECTIONS_PER_HOST = 10
+PDF_CHUNK_SIZE = 64 * 1024
 from google.generativeai.types import GenerationConfig, HarmCategory, HarmBlockThreshold
 safety_settings = {
     HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -25,52 +92,171 @@ api_key = os.environ.get("API_KEY")
 responsive_voice_key = os.environ.get("RESPONSIVE_VOICE_KEY")
 if not api_key or not responsive_voice_key:
     raise ValueError("API keys not found. Please set 'API_KEY' and 'RESPONSIVE_VOICE_KEY' environment variables.")
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel('gemini-2.0-flash-exp',safety_settings=safety_settings)
+genai.configure(api_key=api_key, transport='grpc')
+
+# Number of chapters for each storyLength option
+CHAPTER_COUNTS = {
+    'short': 3,
+    'medium': 5,
+    'long': 7,
+    'grand': 10
+}
+
+# Route each task to the cheapest model tier that handles it well
+DEFAULT_MODEL = 'gemini-2.0-flash-exp'
+PICK_MODEL = {
+    'short': 'gemini-1.5-flash-8b',
+    'medium': DEFAULT_MODEL,
+    'long': DEFAULT_MODEL,
+    'grand': DEFAULT_MODEL
+}
+DEFINITIONS_MODEL = 'gemini-1.5-flash-8b'
+# Every prompt asks for JSON, so have Gemini emit it natively instead of fenced text
+json_generation_config = GenerationConfig(response_mime_type='application/json')
+models = {
+    name: genai.GenerativeModel(name, safety_settings=safety_settings, generation_config=json_generation_config)
+    for name in {DEFAULT_MODEL, DEFINITIONS_MODEL, *PICK_MODEL.values()}
+}
+model = models[DEFAULT_MODEL]
+definitions_model = models[DEFINITIONS_MODEL]
+
+def warm_up_model(warm_model):
+    """Open the Gemini connection so the first story request doesn't pay for it."""
+    try:
+        warm_model.generate_content("warmup", generation_config=GenerationConfig(max_output_tokens=1))
+    except Exception as e:
+        print(f"Model warmup error: {str(e)}")
+
+for warm_model in models.values():
+    gemini_pool.submit(warm_up_model, warm_model)
 
 # --- Helper Functions ---
+# Words of 6+ letters that aren't all-caps acronyms
+_WORD_RE = re.compile(r'\b(?![A-Z]+\b)[A-Za-z]{6,}\b')
+_TITLE_RE = re.compile(r'"title"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# Terms are picked from the opening of each chapter only, bounding the work per chapter
+TERMINOLOGY_SCAN_CHARS = 2000
+# Chapters with fewer candidate terms than this get no terminology section
+MIN_TERMINOLOGY_WORDS = 3
+
+# Everyday words never worth defining
+COMMON_WORDS = frozenset({
+    'there', 'their', 'would', 'could', 'should', 'about', 'which', 'these',
+    'those', 'were', 'have', 'that', 'what', 'when', 'where', 'while', 'from',
+    'been', 'being', 'other', 'another', 'every', 'everything', 'something',
+    'anything', 'nothing', 'through', 'although', 'though', 'without', 'within',
+    'around', 'before', 'after', 'under', 'over', 'because'
+})
+
+IMAGE_BASE_URL = "https://image.pollinations.ai/prompt/"
+_DEFAULT_SUFFIX = "?width=800&height=600&nologo=true"
+FALLBACK_IMAGE_URL = IMAGE_BASE_URL + "scenic%20view" + _DEFAULT_SUFFIX
+
+# Percent-encoding table matching urllib.parse.quote's defaults for ASCII text
+_QUOTE_SAFE = frozenset(string.ascii_letters + string.digits + '_.-~/')
+_QUOTE_TABLE = {c: f'%{c:02X}' for c in range(128) if chr(c) not in _QUOTE_SAFE}
+
+def fast_quote(text):
+    """Percent-encode text like quote(), using a single str.translate for ASCII input."""
+    if text.isascii():
+        return text.translate(_QUOTE_TABLE)
+    return quote(text)
+
+@lru_cache(maxsize=4096)
+def image_url(prompt, width, height):
+    """Pollinations URL for a prompt string; memoized, as it depends only on the arguments."""
+    if width == 800 and height == 600:
+        return IMAGE_BASE_URL + fast_quote(prompt) + _DEFAULT_SUFFIX
+    return f"{IMAGE_BASE_URL}{fast_quote(prompt)}?width={width}&height={height}&nologo=true"
+
 def generate_image(prompt, width=800, height=600):
     """Generate image using Pollinations AI."""
     try:
-        encoded_prompt = quote(prompt)
-        image_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width={width}&height={height}&nologo=true"
-        return image_url
+        # JSON mode doesn't enforce the schema, so the prompt may come back as a list or dict
+        return image_url(str(prompt), width, height)
     except Exception as e:
         print(f"Image generation error: {str(e)}")
-        return "https://image.pollinations.ai/prompt/scenic%20view?width=800&height=600&nologo=true"
-
-def generate_all_images_concurrent(story_data):
-    """Generate all images concurrently using ThreadPoolExecutor."""
-    try:
-        # Create tasks for cover and chapter images
-        cover_prompt = f"A professional book cover with a title on it, '{story_data['title']}', fantasy art"
-        cover_future = executor.submit(generate_image, cover_prompt, 400, 550)
+        return FALLBACK_IMAGE_URL
 
-        chapter_futures = [executor.submit(generate_image, chapter['image_prompt']) for chapter in story_data['chapters']]
+def generate_cover(title):
+    """Generate the book cover image for a story title."""
+    cover_prompt = f"A professional book cover with a title on it, '{title}', fantasy art"
+    return generate_image(cover_prompt, 400, 550)
 
-        # Get results
-        cover_image = cover_future.result()
-        chapter_images = [future.result() for future in chapter_futures]
 
-        # Assign URLs to story data
-        for chapter, image_url in zip(story_data['chapters'], chapter_images):
-            chapter['image'] = image_url
+def extract_json(text):
+    """Parse the outermost JSON object in a model response, ignoring fences or chatter around it."""
+    # JSON-mode replies are usually bare JSON, so try them as-is before slicing
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    start = text.find('{')
+    end = text.rfind('}')
+    if start < 0 or end < start:
+        raise ValueError("No JSON object found in response")
+    return orjson.loads(text[start:end + 1])
+
+
+async def fetch_image(session, url):
+    """Download an image as a data URI, or None if it can't be fetched in time."""
+    try:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            content = await response.read()
+            content_type = response.content_type or 'image/jpeg'
+            return f"data:{content_type};base64,{base64.b64encode(content).decode('ascii')}"
+    except Exception as e:
+        print(f"Image fetch error for {url}: {str(e)}")
+        return None
+
+
+# One long-lived event loop and session keep Pollinations connections alive across downloads
+fetch_loop = asyncio.new_event_loop()
+threading.Thread(target=fetch_loop.run_forever, name='image-fetch', daemon=True).start()
+fetch_session = None
+
+
+async def get_fetch_session():
+    """Create the shared aiohttp session on the fetch loop the first time it's needed."""
+    global fetch_session
+    if fetch_session is None:
+        fetch_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=IMAGE_FETCH_CONNECTIONS,
+                limit_per_host=IMAGE_FETCH_CONNECTIONS_PER_HOST,
+                keepalive_timeout=60,
+            ),
+            timeout=aiohttp.ClientTimeout(total=IMAGE_FETCH_TIMEOUT),
+        )
+    return fetch_session
 
-        return story_data, cover_image
 
-    except Exception as e:
-        print(f"Error in generate_all_images_concurrent: {str(e)}")
-        fallback_url = "https://image.pollinations.ai/prompt/scenic%20view?width=800&height=600&nologo=true"
-        cover_fallback = "https://image.pollinations.ai/prompt/book%20cover?width=400&height=550&nologo=true"
+async def fetch_images(urls):
+    """Download all images concurrently over the shared session."""
+    session = await get_fetch_session()
+    return await asyncio.gather(*(fetch_image(session, url) for url in urls))
 
-        for chapter in story_data['chapters']:
-            chapter['image'] = fallback_url
 
-        return story_data, cover_fallback
+def prefetch_images(urls):
+    """Download images concurrently so the PDF renderer never waits on the network."""
+    unique_urls = [url for url in dict.fromkeys(urls) if url and not url.startswith('data:')]
+    if not unique_urls:
+        return {}
+    future = asyncio.run_coroutine_threadsafe(fetch_images(unique_urls), fetch_loop)
+    try:
+        data_uris = future.result(timeout=IMAGE_PREFETCH_DEADLINE)
+    except FutureTimeoutError:
+        # The fetch loop is stuck or not running (e.g. after a fork); don't hang the request
+        future.cancel()
+        print("Image prefetch timed out; rendering without images")
+        return {}
+    return {url: data_uri for url, data_uri in zip(unique_urls, data_uris) if data_uri}
 
 
-def get_word_definitions(words):
-    """Get definitions using Gemini API with improved prompting and error handling."""
+def request_definitions(words):
+    """Ask Gemini to define words in one batch; returns only the words it answered."""
     prompt = f"""
     Define the following words clearly and concisely, focusing on their most common meanings in everyday usage.
     Words to define: {', '.join(words)}
@@ -87,102 +273,169 @@ def get_word_definitions(words):
     - Suitable for the general audience
     - Focuses on the most common meaning
     """
-    
+
+    response = definitions_model.generate_content(prompt)
+    definitions = extract_json(response.text)
+
+    # Match the returned keys back to the requested words case-insensitively
+    by_lower = {k.lower(): v.strip() for k, v in definitions.items() if isinstance(v, str) and v.strip()}
+    return {word: by_lower[word.lower()] for word in words if word.lower() in by_lower}
+
+
+def get_word_definitions(words):
+    """Get definitions from the disk cache, asking Gemini only for unseen words."""
+    known = {}
+    for word in words:
+        definition = cache.get(f"definition:{word.lower()}")
+        if definition is not None:
+            known[word] = definition
+    misses = [word for word in words if word not in known]
+    if not misses:
+        return known
+
     try:
-        response = model.generate_content(prompt)
-        response_text = response.text.strip()
-        
-        # Clean up the response to ensure it's valid JSON
-        # Remove any markdown formatting if present
-        if '```json' in response_text:
-            response_text = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL).group(1)
-        elif '```' in response_text:
-            response_text = re.search(r'```\s*(.*?)\s*```', response_text, re.DOTALL).group(1)
-            
-        # Remove any remaining non-JSON text
-        response_text = re.search(r'\{.*\}', response_text, re.DOTALL).group(0)
-        
-        definitions = json.loads(response_text)
-        
-        # Ensure all requested words have definitions
-        final_definitions = {}
-        for word in words:
-            word_lower = word.lower()
-            # Try to find the word in the definitions (case-insensitive)
-            matching_key = next((k for k in definitions.keys() if k.lower() == word_lower), None)
-            if matching_key and definitions[matching_key].strip():
-                final_definitions[word] = definitions[matching_key]
-            else:
-                # If definition is missing, make another attempt for just this word
-                single_word_prompt = f"""
-                Define this word clearly and concisely in 10-15 words:
-                Word: {word}
-
-                Respond ONLY with the definition (no other text).
-                """
-                try:
-                    retry_response = model.generate_content(single_word_prompt)
-                    definition = retry_response.text.strip()
-                    if definition:
-                        final_definitions[word] = definition
-                    else:
-                        final_definitions[word] = "No definition available"
-                except Exception:
-                    final_definitions[word] = "No definition available"
-                    
-        return final_definitions
-        
+        new_definitions = request_definitions(misses)
     except Exception as e:
         print(f"Error getting definitions: {str(e)}")
-        return {word: f"Definition not available due to error: {str(e)}" for word in words}
+        return {word: known.get(word, f"Definition not available due to error: {str(e)}") for word in words}
 
+    # Retry the words Gemini skipped in a single follow-up batch
+    missing = [word for word in misses if word not in new_definitions]
+    if missing:
+        try:
+            new_definitions.update(request_definitions(missing))
+        except Exception as e:
+            print(f"Error retrying definitions: {str(e)}")
 
-def extract_terminology(text):
-    """Extract 4-5 significant terms and get their definitions using Gemini."""
-    # Find words that are potentially complex or important
-    words = re.findall(r'\b[A-Za-z]{5,}\b', text)
-    
-    # Remove common words and duplicates
-    common_words = {
-        'there', 'their', 'would', 'could', 'should', 'about', 'which', 'these', 
-        'those', 'were', 'have', 'that', 'what', 'when', 'where', 'while', 'from',
-        'been', 'being', 'other', 'another', 'every', 'everything', 'something',
-        'anything', 'nothing', 'through', 'although', 'though', 'without', 'within',
-        'around', 'before', 'after', 'under', 'over', 'because'
-    }
-    
-    # Filter words
-    filtered_words = []
-    for word in words:
+    with cache.transact():
+        for word, definition in new_definitions.items():
+            cache.set(f"definition:{word.lower()}", definition, expire=DEFINITION_CACHE_TTL)
+
+    known.update(new_definitions)
+    return {word: known.get(word, "No definition available") for word in words}
+
+
+def candidate_words(text):
+    """Pick the 4-5 most significant terms in a text, without defining them."""
+    scan = text[:TERMINOLOGY_SCAN_CHARS]
+    if len(text) > TERMINOLOGY_SCAN_CHARS and text[TERMINOLOGY_SCAN_CHARS] in string.ascii_letters:
+        # Don't let a word cut in half by the cap become a candidate
+        scan = scan.rstrip(string.ascii_letters)
+
+    # The regex already drops short words, acronyms and anything with digits;
+    # filter common words and dedup (case-insensitively, keeping the first spelling) in one pass
+    unique_words = {}
+    for word in _WORD_RE.findall(scan):
         word_lower = word.lower()
-        if (
-            word_lower not in common_words and
-            not word.isupper() and  # Skip acronyms
-            len(word) >= 6 and  # Focus on longer words
-            not any(char.isdigit() for char in word)  # Skip words with numbers
-        ):
-            filtered_words.append(word)
-    
-    # Remove duplicates while preserving case
-    unique_words = []
-    seen_words = set()
-    for word in filtered_words:
-        if word.lower() not in seen_words:
-            unique_words.append(word)
-            seen_words.add(word.lower())
-    
+        if word_lower not in COMMON_WORDS:
+            unique_words.setdefault(word_lower, word)
+
     # Select the most interesting words (prioritize longer, less common words)
-    selected_words = sorted(unique_words, key=lambda x: (len(x), x.lower()), reverse=True)[:5]
-    
-    if selected_words:
-        # Get definitions using improved Gemini function
+    return heapq.nlargest(5, unique_words.values(), key=lambda x: (len(x), x.lower()))
+
+
+def add_terminology(chapters):
+    """Define the key terms of every chapter with a single batched lookup."""
+    per_chapter_words = []
+    for chapter in chapters:
+        words = candidate_words(chapter['content'])
+        # Skip chapters with too few interesting words, as extract_terminology does
+        per_chapter_words.append(words if len(words) >= MIN_TERMINOLOGY_WORDS else [])
+
+    # The same word often recurs across chapters with different casing; ask for it once
+    unique_words = {}
+    for words in per_chapter_words:
+        for word in words:
+            unique_words.setdefault(word.lower(), word)
+    definitions = get_word_definitions(list(unique_words.values())) if unique_words else {}
+    by_lower = {
+        word.lower(): definition for word, definition in definitions.items()
+        if definition and definition != "No definition available"
+    }
+
+    for chapter, words in zip(chapters, per_chapter_words):
+        chapter['terminology'] = {word: by_lower[word.lower()] for word in words if word.lower() in by_lower}
+
+
+def extract_terminology(text):
+    """Extract 4-5 significant terms and get their definitions using Gemini."""
+    selected_words = candidate_words(text)
+    # Too few interesting words to be worth a Gemini call
+    if len(selected_words) >= MIN_TERMINOLOGY_WORDS:
         definitions = get_word_definitions(selected_words)
         return {k: v for k, v in definitions.items() if v and v != "No definition available"}
     return {}
 
 # --- Story Generation and Editing Functions ---
-def generate_story(keywords, genre, num_chapters, tone, style, age_group, include_magic, include_romance, include_conflict):
-    """Generate story content using Gemini API with enhanced parameters."""
+class ChapterStreamParser:
+    """Pull complete chapter objects out of a story JSON as it streams in from Gemini."""
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._chapter_start = None
+
+    def feed(self, text):
+        """Append a streamed fragment and return any chapters it completed."""
+        self.buffer += text
+        buffer = self.buffer
+        chapters = []
+        for i in range(self._pos, len(buffer)):
+            char = buffer[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+                # Chapters are the objects nested directly inside the story object
+                if self._depth == 2:
+                    self._chapter_start = i
+            elif char == '}':
+                if self._depth == 2 and self._chapter_start is not None:
+                    try:
+                        chapter = orjson.loads(buffer[self._chapter_start:i + 1])
+                        if isinstance(chapter, dict) and 'content' in chapter:
+                            chapters.append(chapter)
+                    except orjson.JSONDecodeError:
+                        pass
+                    self._chapter_start = None
+                self._depth -= 1
+        self._pos = len(buffer)
+        return chapters
+
+
+def fallback_story(genre):
+    """Placeholder story returned when Gemini output cannot be used."""
+    return {
+        "title": f"{genre.title()} Story",
+        "author": "AI Author",
+        "moral": "Could not generate a moral for the story",
+        "chapters": [{
+            "chapter_number": 1,
+            "chapter_title": "Chapter 1",
+            "content": "Story generation failed. Please try again.",
+            "image_prompt": "A blank page with some text",
+            "terminology": {}
+        }]
+    }
+
+
+def generate_story(keywords, genre, num_chapters, tone, style, age_group, include_magic, include_romance, include_conflict, story_model=model):
+    """Stream story content from Gemini.
+
+    Yields ``('chapter', {'chapter': ...})`` as soon as each chapter object is
+    complete, then ``('done', {'story': ..., 'cover_image': ..., 'fallback': ...})``,
+    where ``fallback`` marks placeholder content that shouldn't be cached.
+    """
     prompt = f"""
     Create a captivating story based on the following:
     Keywords: {keywords}
@@ -212,57 +465,61 @@ def generate_story(keywords, genre, num_chapters, tone, style, age_group, includ
     }}
     """
 
+    parser = ChapterStreamParser()
+    chapters = []
+    title = None
     try:
-        response = model.generate_content(prompt)
-        response_text = response.text
-
-        # Parse JSON with multiple fallback attempts
+        for chunk in story_model.generate_content(prompt, stream=True):
+            # The closing chunk and safety stops carry no parts, and chunk.text raises on them
+            if not chunk.parts:
+                continue
+            new_chapters = parser.feed(chunk.text)
+            if title is None:
+                # Remembered in case the stream fails before the full story parses
+                title_match = _TITLE_RE.search(parser.buffer)
+                if title_match:
+                    title = orjson.loads(f'"{title_match.group(1)}"')
+            for chapter in new_chapters:
+                # The image URL is just formatted, so attach it inline; terms are batched at the end
+                chapter['image'] = generate_image(chapter['image_prompt'])
+                chapter['terminology'] = {}
+                chapters.append(chapter)
+                yield 'chapter', {'chapter': chapter}
+
+        fallback = False
         try:
-            story_data = json.loads(response_text)
-        except json.JSONDecodeError:
-            # Try finding JSON in markdown code blocks
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-            if json_match:
-                story_data = json.loads(json_match.group(1))
-            else:
-                # Try finding content between curly braces
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    story_data = json.loads(json_match.group(0))
-                else:
-                    story_data = {
-                        "title": f"{genre.title()} Story",
-                        "author": "AI Author",
-                        "moral": "Could not generate a moral for the story",
-                        "chapters": [{
-                            "chapter_number": 1,
-                            "chapter_title": "Chapter 1",
-                            "content": "Story generation failed. Please try again.",
-                            "image_prompt": "A blank page with some text",
-                            "terminology": {}
-                        }]
-                    }
-
-        # Add terminology to each chapter
-        for chapter in story_data['chapters']:
-            chapter['terminology'] = extract_terminology(chapter['content'])
+            story_data = extract_json(parser.buffer)
+        except ValueError:
+            story_data = fallback_story(genre)
+            fallback = True
+
+        if chapters:
+            # Keep the chapters already processed while streaming
+            story_data['chapters'] = chapters
+        else:
+            for chapter in story_data['chapters']:
+                chapter['image'] = generate_image(chapter['image_prompt'])
+
+        # Define terms for the whole story in one round-trip
+        add_terminology(story_data['chapters'])
 
-        return story_data
+        yield 'done', {'story': story_data, 'cover_image': generate_cover(story_data['title']), 'fallback': fallback}
 
     except Exception as e:
         print(f"Error generating story: {str(e)}")
-        return {
-            "title": f"{genre.title()} Story",
-            "author": "AI Author",
-            "moral": "Could not generate a moral for the story",
-            "chapters": [{
-                "chapter_number": 1,
-                "chapter_title": "Chapter 1",
-                "content": "Story generation failed. Please try again.",
-                "image_prompt": "A blank page with some text",
-                "terminology": {}
-            }]
-        }
+        if chapters:
+            # The client already has these chapters, so finish the story with them
+            story_data = fallback_story(genre)
+            story_data['chapters'] = chapters
+            if title is not None:
+                story_data['title'] = title
+            add_terminology(chapters)
+            yield 'done', {'story': story_data, 'cover_image': generate_cover(story_data['title']), 'fallback': True}
+            return
+        story_data = fallback_story(genre)
+        for chapter in story_data['chapters']:
+            chapter['image'] = generate_image(chapter['image_prompt'])
+        yield 'done', {'story': story_data, 'cover_image': generate_cover(story_data['title']), 'fallback': True}
 
 def regenerate_chapter(story_data, chapter_number, tone, style, include_magic, include_romance, include_conflict):
     """Regenerate a specific chapter."""
@@ -299,23 +556,18 @@ def regenerate_chapter(story_data, chapter_number, tone, style, include_magic, i
     try:
         response = model.generate_content(prompt)
         try:
-            new_chapter = json.loads(response.text)
-        except json.JSONDecodeError:
-            json_match = re.search(r'```json\s*(.*?)\s*```', response.text, re.DOTALL)
-            if json_match:
-                new_chapter = json.loads(json_match.group(1))
-            else:
-                json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
-                if json_match:
-                    new_chapter = json.loads(json_match.group(0))
-                else:
-                    new_chapter = {
-                        "chapter_number": chapter_number,
-                        "chapter_title": "Regenerated Chapter",
-                        "content": "Failed to regenerate chapter. Please try again.",
-                        "image_prompt": "A blank page with some text",
-                        "terminology": {}
-                    }
+            new_chapter = extract_json(response.text)
+        except ValueError:
+            new_chapter = {
+                "chapter_number": chapter_number,
+                "chapter_title": "Regenerated Chapter",
+                "content": "Failed to regenerate chapter. Please try again.",
+                "image_prompt": "A blank page with some text",
+                "terminology": {}
+            }
+
+        # Regenerate image for the chapter
+        new_chapter['image'] = generate_image(new_chapter['image_prompt'])
 
         # Add terminology
         new_chapter['terminology'] = extract_terminology(new_chapter['content'])
@@ -323,9 +575,6 @@ def regenerate_chapter(story_data, chapter_number, tone, style, include_magic, i
         # Replace old chapter with new chapter
         story_data['chapters'][chapter_index] = new_chapter
 
-        # Regenerate image for the chapter
-        new_chapter['image'] = generate_image(new_chapter['image_prompt'])
-
         return new_chapter
 
     except Exception as e:
@@ -339,7 +588,7 @@ def regenerate_chapter(story_data, chapter_number, tone, style, include_magic, i
         }
 
 def continue_story(previous_story, num_new_chapters, tone, style, include_magic, include_romance, include_conflict):
-    """Generate additional chapters for an existing story with enhanced parameters."""
+    """Generate additional chapters, with images, for an existing story with enhanced parameters."""
     prompt = f"""
     Continue this story with {num_new_chapters} more chapters, maintaining the established themes and characters.
     Previous story title: {previous_story['title']}
@@ -367,29 +616,24 @@ def continue_story(previous_story, num_new_chapters, tone, style, include_magic,
     try:
         response = model.generate_content(prompt)
         try:
-            new_chapters = json.loads(response.text)
-        except json.JSONDecodeError:
-            json_match = re.search(r'```json\s*(.*?)\s*```', response.text, re.DOTALL)
-            if json_match:
-                new_chapters = json.loads(json_match.group(1))
-            else:
-                json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
-                if json_match:
-                    new_chapters = json.loads(json_match.group(0))
-                else:
-                    new_chapters = {
-                        "chapters": [{
-                            "chapter_number": len(previous_story['chapters']) + 1,
-                            "chapter_title": "New Chapter",
-                            "content": "Failed to generate new content. Please try again.",
-                            "image_prompt": "A blank page with some text",
-                            "terminology": {}
-                        }]
-                    }
-
-        # Add terminology to each new chapter
+            new_chapters = extract_json(response.text)
+        except ValueError:
+            new_chapters = {
+                "chapters": [{
+                    "chapter_number": len(previous_story['chapters']) + 1,
+                    "chapter_title": "New Chapter",
+                    "content": "Failed to generate new content. Please try again.",
+                    "image_prompt": "A blank page with some text",
+                    "terminology": {}
+                }]
+            }
+
+        # Generate images for the new chapters
         for chapter in new_chapters['chapters']:
-            chapter['terminology'] = extract_terminology(chapter['content'])
+            chapter['image'] = generate_image(chapter['image_prompt'])
+
+        # Add terminology to the new chapters in one batch
+        add_terminology(new_chapters['chapters'])
 
         return new_chapters['chapters']
     except Exception as e:
@@ -399,10 +643,54 @@ def continue_story(previous_story, num_new_chapters, tone, style, include_magic,
             "chapter_title": "New Chapter",
             "content": "Failed to generate new content. Please try again.",
             "image_prompt": "A blank page with some text",
+            "image": generate_image("A blank page with some text"),
             "terminology": {}
         }]
 
 # --- Routes ---
+def request_json():
+    """Parse the request body with orjson."""
+    return orjson.loads(request.get_data())
+
+def ojson(payload, status=200):
+    """Build a JSON response encoded with orjson."""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
+# Keep proxies (e.g. nginx) and the browser from buffering or caching the event stream
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def sse(payload):
+    """Encode a payload as a server-sent event frame."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+def request_cache_key(data):
+    """Canonical hash of a request body, independent of key order."""
+    return "story:" + hashlib.blake2b(orjson.dumps(data, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+def run_job(job_id, func, error_message):
+    """Run a job on a worker thread and record its outcome for /status."""
+    try:
+        job = {'status': 'done', 'result': func()}
+    except Exception as e:
+        print(f"Error in job {job_id}: {str(e)}")
+        job = {'status': 'error', 'error': error_message, 'details': str(e)}
+    cache.set(f"job:{job_id}", job, expire=JOB_TTL)
+
+def start_job(func, error_message):
+    """Queue slow Gemini work and answer 202 with a job id the client polls."""
+    if not BACKGROUND_JOBS:
+        # No long-lived worker to finish the job after we respond, so answer inline
+        return ojson(func())
+    job_id = uuid.uuid4().hex
+    # Job state lives in the shared cache so any worker process can answer /status
+    cache.set(f"job:{job_id}", {'status': 'pending'}, expire=JOB_TTL)
+    gemini_pool.submit(run_job, job_id, func, error_message)
+    return ojson({'job_id': job_id}, 202)
+
+@app.errorhandler(404)
+def not_found(error):
+    return ojson({'error': 'Invalid endpoint'}, 404)
+
 @app.route('/')
 def index():
     return render_template('index.html', responsive_voice_key=responsive_voice_key)
@@ -410,7 +698,7 @@ def index():
 @app.route('/generate', methods=['POST'])
 def generate():
     try:
-        data = request.get_json()
+        data = request_json()
         keywords = data.get('keywords')
         genre = data.get('genre')
         story_length = data.get('storyLength')
@@ -422,34 +710,37 @@ def generate():
         include_conflict = data.get('includeConflict')
 
         # Determine the number of chapters based on story length
-        num_chapters = {
-            'short': 3,
-            'medium': 5,
-            'long': 7,
-            'grand': 10
-        }.get(story_length, 3)
-
-        # Generate story content
-        story = generate_story(keywords, genre, num_chapters, tone, style, age_group, include_magic, include_romance, include_conflict)
-
-        # Generate all images concurrently
-        story, cover_image = generate_all_images_concurrent(story)
-
-        return jsonify({
-            'story': story,
-            'cover_image': cover_image
-        })
+        num_chapters = CHAPTER_COUNTS.get(story_length, 3)
+        story_model = models[PICK_MODEL.get(story_length, DEFAULT_MODEL)]
+
+        cache_key = request_cache_key(data)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return Response(sse({'type': 'done', **cached}), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+        def stream():
+            try:
+                for event, payload in generate_story(keywords, genre, num_chapters, tone, style, age_group, include_magic, include_romance, include_conflict, story_model):
+                    if event == 'done' and not payload['fallback']:
+                        # Only cache stories that actually came back from Gemini
+                        cache.set(cache_key, payload, expire=STORY_CACHE_TTL)
+                    yield sse({'type': event, **payload})
+            except Exception as e:
+                print(f"Error in generate stream: {str(e)}")
+                yield sse({'type': 'error', 'error': 'Failed to generate story', 'details': str(e)})
+
+        return Response(stream_with_context(stream()), mimetype='text/event-stream', headers=SSE_HEADERS)
     except Exception as e:
         print(f"Error in generate route: {str(e)}")
-        return jsonify({
+        return ojson({
             'error': 'Failed to generate story',
             'details': str(e)
-        }), 500
+        }, 500)
 
 @app.route('/regenerate', methods=['POST'])
 def regenerate():
     try:
-        data = request.get_json()
+        data = request_json()
         story_data = data.get('story')
         chapter_number = int(data.get('chapter_number'))
         tone = data.get('tone')
@@ -458,21 +749,23 @@ def regenerate():
         include_romance = data.get('includeRomance')
         include_conflict = data.get('includeConflict')
 
-        new_chapter = regenerate_chapter(story_data, chapter_number, tone, style, include_magic, include_romance, include_conflict)
+        def run():
+            new_chapter = regenerate_chapter(story_data, chapter_number, tone, style, include_magic, include_romance, include_conflict)
+            return {'story': story_data, 'new_chapter': new_chapter}
 
-        return jsonify({'story': story_data, 'new_chapter': new_chapter})
+        return start_job(run, 'Failed to regenerate chapter')
 
     except Exception as e:
         print(f"Error in regenerate route: {str(e)}")
-        return jsonify({
+        return ojson({
             'error': 'Failed to regenerate chapter',
             'details': str(e)
-        }), 500
+        }, 500)
 
 @app.route('/continue', methods=['POST'])
 def continue_story_route():
     try:
-        data = request.get_json()
+        data = request_json()
         previous_story = data.get('previous_story')
         num_new_chapters = int(data.get('num_new_chapters', 3))
         tone = data.get('tone')
@@ -481,81 +774,77 @@ def continue_story_route():
         include_romance = data.get('includeRomance')
         include_conflict = data.get('includeConflict')
 
-        # Generate new chapters
-        new_chapters = continue_story(previous_story, num_new_chapters, tone, style, include_magic, include_romance, include_conflict)
+        def run():
+            # Generate new chapters, with their images
+            new_chapters = continue_story(previous_story, num_new_chapters, tone, style, include_magic, include_romance, include_conflict)
+            return {'new_chapters': new_chapters}
 
-        # Generate images for new chapters concurrently
-        futures = [executor.submit(generate_image, chapter['image_prompt'])
-                  for chapter in new_chapters]
-
-        # Wait for all image generations to complete
-        for chapter, future in zip(new_chapters, futures):
-            chapter['image'] = future.result()
-
-        return jsonify({'new_chapters': new_chapters})
+        return start_job(run, 'Failed to continue story')
     except Exception as e:
         print(f"Error in continue route: {str(e)}")
-        return jsonify({
+        return ojson({
             'error': 'Failed to continue story',
             'details': str(e)
-        }), 500
+        }, 500)
+
+@app.route('/status/<job_id>')
+def job_status(job_id):
+    job = cache.get(f"job:{job_id}")
+    if job is None:
+        return ojson({'error': 'Unknown job'}, 404)
+    return ojson(job)
 
 @app.route('/get_moral', methods=['POST'])
 def get_moral():
     try:
-        data = request.get_json()
+        data = request_json()
         story_data = data.get('story')
-        return jsonify({'moral': story_data['moral']})
+        return ojson({'moral': story_data['moral']})
     except Exception as e:
         print(f"Error in get_moral route: {str(e)}")
-        return jsonify({
+        return ojson({
             'error': 'Failed to retrieve moral',
             'details': str(e)
-        }), 500
+        }, 500)
 
 @app.route('/download', methods=['POST'])
 def download_pdf():
     try:
-        data = request.get_json()
+        data = request_json()
         story_data = data.get('story')
         cover_image = data.get('cover_image')
         
-        # Configure PDF options
-        pdf_options = {
-            'page-size': 'A4',
-            'margin-top': '2.5cm',
-            'margin-right': '2cm',
-            'margin-bottom': '2.5cm',
-            'margin-left': '2cm',
-            'encoding': 'UTF-8',
-        }
-        
+        # Fetch every image up front; ones that time out are left out of the PDF
+        images = prefetch_images([cover_image] + [chapter.get('image') for chapter in story_data['chapters']])
+
         # Generate HTML
-        pdf_html = render_template('pdf_template.html', story=story_data, cover_image=cover_image)
+        pdf_html = PDF_TEMPLATE.render(story=story_data, cover_image=cover_image, images=images)
         
         # Create PDF
         pdf_buffer = BytesIO()
-        pisa.CreatePDF(
-            pdf_html, 
-            dest=pdf_buffer,
-            encoding='utf-8',
-        )
+        if HTML is not None:
+            HTML(string=pdf_html, base_url=request.host_url).write_pdf(pdf_buffer, optimize_size=('fonts', 'images'))
+        else:
+            pisa.CreatePDF(pdf_html, dest=pdf_buffer, encoding='utf-8')
         
         pdf_buffer.seek(0)
         
-        # Create response
-        response = make_response(pdf_buffer.read())
-        response.headers['Content-Type'] = 'application/pdf'
-        response.headers['Content-Disposition'] = f'attachment; filename="{story_data["title"].replace(" ", "_")}.pdf"'
-        
-        return response
+        # Stream the PDF out in chunks instead of copying the whole buffer into the response
+        return Response(
+            iter(lambda: pdf_buffer.read(PDF_CHUNK_SIZE), b''),
+            mimetype='application/pdf',
+            headers={
+                'Content-Disposition': f'attachment; filename="{story_data["title"].replace(" ", "_")}.pdf"',
+                'Content-Length': str(pdf_buffer.getbuffer().nbytes),
+            }
+        )
         
     except Exception as e:
         print(f"Download PDF Error: {str(e)}")
-        return jsonify({
+        return ojson({
             "error": "Error generating PDF",
             "details": str(e)
-        }), 500
+        }, 500)
 # --- Main ---
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,13 @@
+import multiprocessing
+import os
+
+# Threaded workers so slow Gemini calls overlap instead of serializing requests
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+# Story streams and PDF renders run for tens of seconds; don't cut them off on reload
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = timeout
+keepalive = 5